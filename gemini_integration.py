@@ -4,11 +4,19 @@ Handles natural language queries and generates friendly explanations
 """
 
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+import asyncio
+import collections
 import re
+import string
 import json
 import os
 import sys
-import dotenv
+import hashlib
+import random
+import sqlite3
+import threading
+import time
 
 # Try to load environment variables from a .env file if python-dotenv is installed.
 try:
@@ -18,14 +26,815 @@ except Exception:
     # If python-dotenv isn't installed, we'll rely on the environment variables.
     pass
 
+# Optional semantic cache dependencies (see SemanticCache)
+try:
+    import numpy as np
+    import faiss
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+from ml_debugging_expert import DIAG_TEMPLATES, ISSUE_CONDITIONS, THRESHOLDS
+
+# Use gemini-2.5-flash (fast and efficient for general tasks)
+MODEL_NAME = 'models/gemini-2.5-flash'
+
+# Response cache location and policy (see _CachedModel), override with GEMINI_CACHE_PATH
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "mldebug", "gemini.sqlite")
+CACHE_MODES = ("enabled", "replay", "write-only", "disabled")
+
+# Client-side API quota (requests / tokens per minute), set with GEMINI_RPM_LIMIT / GEMINI_TPM_LIMIT.
+# Off by default (0): quotas differ by tier, and a limit below the real one only slows every request.
+RPM_LIMIT = 0
+TPM_LIMIT = 0
+
+# Server-side errors (429 / 504 / 503) worth retrying with exponential backoff before giving up
+TRANSIENT_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.ServiceUnavailable,
+)
+RETRY_ATTEMPTS = 5
+RETRY_MAX_WAIT = 30
+
+# Per-request timeout in seconds (cuts off tail-latency outliers so they are retried)
+REQUEST_TIMEOUT = float(os.getenv("GEMINI_REQUEST_TIMEOUT", 15))
+
+# Timeout in seconds for the single best-effort warm-up request
+WARMUP_TIMEOUT = 5
+
+# Transient API errors seen in this process, by exception name
+ERROR_COUNTS = collections.Counter()
+
+# Small local embedding model for the semantic cache (384-dim)
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SEMANTIC_THRESHOLD = 0.92
+
+_NUMBER_RE = re.compile(r'\d+(?:\.\d+)?')
+
+# Start of a candidate JSON object in free text (see _parse_json)
+_JSON_START_RE = re.compile(r'\{')
+_JSON_DECODER = json.JSONDecoder()
+
+# Structured output schema for extracted metrics (OpenAPI subset used by Gemini)
+_METRICS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "train_accuracy": {"type": "number", "nullable": True},
+        "test_accuracy": {"type": "number", "nullable": True},
+        "validation_accuracy": {"type": "number", "nullable": True},
+        "loss_oscillation": {"type": "string", "enum": ["high", "medium", "low"], "nullable": True},
+        "convergence_speed": {"type": "string", "enum": ["very_slow", "slow", "normal", "fast"], "nullable": True},
+        "dataset_size": {"type": "integer", "nullable": True},
+        "batch_size": {"type": "integer", "nullable": True},
+        "learning_rate": {"type": "number", "nullable": True},
+        "epochs": {"type": "integer", "nullable": True},
+    },
+}
+
+_EXTRACT_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": _METRICS_SCHEMA,
+}
+
+
+# Expert system diagnosis headings ("OVERFITTING DETECTED") mapped to issue labels
+_ISSUE_LABELS = {template.split(":")[0]: issue for issue, template in DIAG_TEMPLATES.items()}
+
+
+def _draft_config(with_metrics=False):
+    """Structured output for drafts: the issues found (expert system labels) and the explanation"""
+    properties = {
+        "issues": {"type": "array", "items": {"type": "string", "enum": list(_ISSUE_LABELS.values())}},
+        "explanation": {"type": "string"},
+    }
+    if with_metrics:
+        properties["metrics"] = _METRICS_SCHEMA
+    return {
+        "response_mime_type": "application/json",
+        "response_schema": {"type": "object", "properties": properties, "required": list(properties)},
+    }
+
+# Local fast path for simple queries like "92% train / 68% test" (see _extract_local)
+_NUM = r'(\d+(?:\.\d+)?)(?![\d.]|,\d)'
+_ACC_LABELS = {"train": "train_accuracy", "test": "test_accuracy", "val": "validation_accuracy"}
+_RE_ACC_LABEL = re.compile(r'\b(train|test|val)(?:ing|idation)?\b', re.I)
+# Number right after a label ("train accuracy of 92%") ...
+_RE_ACC_AFTER = re.compile(
+    r'(?:\s+set)?(?:\s+acc(?:uracy)?)?\s*(?:of|is|was|=|:)?\s*' + _NUM
+    + r'\s*(%)?(?!\s*(?:epochs?|samples|examples|images))', re.I)
+# ... or right before it ("92% accuracy on the train")
+_RE_ACC_BEFORE = re.compile(
+    r'(?<![\d.])' + _NUM + r'\s*(%)\s*(?:acc(?:uracy)?\s+)?(?:on\s+(?:the\s+)?)?$', re.I)
+_SAMPLES = r'(?:training\s+)?(?:samples|examples|images|data\s*points|rows|records)'
+_DATASET = r'(?:data\s*set|training\s+(?:set|data))'
+# A dataset size must be tied to the dataset ("5,000 samples in the dataset", "training set of 5,000") ...
+_RE_DATASET = re.compile(
+    r'(\d[\d,]*)\s*' + _SAMPLES + r'?\s*(?:in\s+|for\s+)?(?:the\s+|our\s+|my\s+)?' + _DATASET + r'\b'
+    r'|\b' + _DATASET + r'(?:\s+size)?\s*(?:of|is|was|has|with|=|:)?\s*(\d[\d,]*)', re.I)
+# ... other sample counts ("32 samples per batch") are left to the LLM
+_RE_SAMPLES = re.compile(r'(\d[\d,]*)\s*' + _SAMPLES + r'\b', re.I)
+_RE_BATCH = re.compile(r'\bbatch\s*size\s*(?:of|is|was|=|:)?\s*(\d+)|(\d+)\s*batch\s*size', re.I)
+_RE_LR = re.compile(r'(?:\blearning\s*rate|\blr)\s*(?:of|is|was|=|:)?\s*(\d*\.?\d+(?:e-?\d+)?)', re.I)
+_RE_EPOCHS = re.compile(r'(\d+)\s*epochs?\b|\bepochs?\s*(?:of|is|was|=|:)?\s*(\d+)', re.I)
+
+# Mentions the local patterns can't capture (loss behaviour, convergence) need the LLM
+_RE_NEEDS_LLM = re.compile(r'loss|oscillat|fluctuat|converg|slow|plateau|stuck|jump', re.I)
+
+_LOCAL_PATTERNS = (
+    ("dataset_size", _RE_DATASET, lambda v: int(v.replace(",", ""))),
+    ("batch_size", _RE_BATCH, int),
+    ("learning_rate", _RE_LR, float),
+    ("epochs", _RE_EPOCHS, int),
+)
+
+
+def _parse_json(text):
+    """
+    Parse the JSON object in a model response
+
+    Structured output is plain JSON, but cached or fallback responses may wrap
+    it in a code fence or prose, so the first complete object (nested braces
+    included) is decoded from the text.
+    """
+    try:
+        result = json.loads(text)
+    except json.JSONDecodeError:
+        result = None
+    if isinstance(result, dict):
+        return result
+
+    for match in _JSON_START_RE.finditer(text):
+        try:
+            result, _ = _JSON_DECODER.raw_decode(text, match.start())
+        except json.JSONDecodeError:
+            continue
+        if isinstance(result, dict):
+            return result
+    raise ValueError("No JSON object found in the response")
+
+
+def _accuracy_value(number, percent):
+    """Accuracy as a percentage, accepting fractions (0.92) written without a % sign"""
+    value = float(number)
+    if not percent and value <= 1:
+        value = round(value * 100, 2)
+    return value
+
+
+def _accuracies_local(user_query):
+    """
+    Bind each accuracy number in a query to exactly one train/test/validation label
+
+    A number can sit after its label ("train 92%") or before it ("92% on train").
+    When every labelled value sits on the same side, that reading is used for the
+    whole query; otherwise each label takes the only number it can reach.
+    Returns a list of (metric, value) pairs, or None if a number could belong to
+    two labels or would be left without one.
+    """
+    labels = []
+    for match in _RE_ACC_LABEL.finditer(user_query):
+        after = _RE_ACC_AFTER.match(user_query, match.end())
+        before = _RE_ACC_BEFORE.search(user_query, 0, match.start())
+        numbers = [(m.start(1), _accuracy_value(*m.group(1, 2))) for m in (after, before) if m]
+        if numbers:  # otherwise a mention without a value ("the training set")
+            labels.append((_ACC_LABELS[match.group(1).lower()], after is not None, before is not None, numbers))
+
+    if labels and all(has_after for _, has_after, _, _ in labels):
+        chosen = [(key, numbers[0]) for key, _, _, numbers in labels]
+    elif labels and all(has_before for _, _, has_before, _ in labels):
+        chosen = [(key, numbers[-1]) for key, _, _, numbers in labels]
+    else:
+        chosen = [(key, number) for key, _, _, numbers in labels for number in numbers]
+
+    # Each number must be read as exactly one metric, and none may be left over
+    owners = {}
+    for key, (position, _) in chosen:
+        if owners.setdefault(position, key) != key:
+            return None
+    if owners.keys() != {position for *_, numbers in labels for position, _ in numbers}:
+        return None
+    return [(key, value) for key, (_, value) in chosen]
+
+
+def _metrics_local(user_query):
+    """
+    Metric values the local patterns find in a query
+
+    Returns None when the query is ambiguous (a number could belong to two
+    metrics, a metric matched with different values, or a sample count isn't
+    tied to the dataset).
+    """
+    pairs = _accuracies_local(user_query)
+    if pairs is None:
+        return None
+    dataset_numbers = {m.start(m.lastindex) for m in _RE_DATASET.finditer(user_query)}
+    if any(m.start(1) not in dataset_numbers for m in _RE_SAMPLES.finditer(user_query)):
+        return None
+    for key, pattern, convert in _LOCAL_PATTERNS:
+        pairs.extend((key, convert(next(g for g in m.groups() if g))) for m in pattern.finditer(user_query))
+
+    metrics = {}
+    for key, value in pairs:
+        if metrics.setdefault(key, value) != value:
+            return None
+    return metrics
+
+
+def _extract_local(user_query):
+    """
+    Extract metrics from simple queries with regular expressions
+
+    Returns an empty dict when the query is ambiguous or mentions something
+    only the LLM can interpret.
+    """
+    if _RE_NEEDS_LLM.search(user_query):
+        return {}
+
+    metrics = _metrics_local(user_query)
+    if metrics is None:
+        return {}
+
+    for key in ("train_accuracy", "test_accuracy", "validation_accuracy"):
+        if metrics.get(key, 0) > 100:
+            return {}
+    return metrics
+
+
+# Prompts keep their long, fixed instructions first and the per-request text
+# (query, diagnosis, conversation) last, so consecutive requests share a
+# byte-identical prefix that Gemini's prompt caching can reuse.
+
+# The expert system's issue labels and when each applies (drafts must use the same labels)
+_ISSUE_GUIDE = "".join(
+    f"- {issue}: {condition.format_map(THRESHOLDS)}\n" for issue, condition in ISSUE_CONDITIONS.items()
+)
+
+# Prompt for metric extraction
+_EXTRACT_PROMPT = string.Template("""
+You are an expert at extracting ML training metrics from natural language descriptions.
+
+Extract the following metrics from the user query below if mentioned (return null if not mentioned):
+- train_accuracy (percentage, 0-100)
+- test_accuracy (percentage, 0-100)
+- validation_accuracy (percentage, 0-100)
+- loss_oscillation ("high", "medium", "low", or null)
+- convergence_speed ("very_slow", "slow", "normal", "fast", or null)
+- dataset_size (number of samples)
+- batch_size (number)
+- learning_rate (decimal number)
+- epochs (number)
+
+Return ONLY a valid JSON object with these fields. Use null for missing values.
+Example: {"train_accuracy": 95, "test_accuracy": 70, "dataset_size": null, "batch_size": null}
+
+User Query: "$user_query"
+""")
+
+# Prompt for explanation of an expert system diagnosis
+_EXPLAIN_PROMPT = string.Template("""
+You are a friendly ML debugging assistant helping a student understand their model's issues.
+
+Using the student's question and the expert system output below, provide a clear, friendly,
+and educational explanation that:
+1. Summarizes the main problem in simple terms
+2. Explains WHY this is happening
+3. Gives actionable next steps
+4. Includes a brief code example if relevant
+
+Keep it concise (2-3 paragraphs) and encouraging.
+
+Original Question: "$user_query"
+
+Expert System Diagnosis:
+$diagnoses
+
+Recommendations:
+$recommendations
+""")
+
+# Prompt for combined extraction + explanation
+_EXTRACT_AND_EXPLAIN_PROMPT = string.Template("""
+You are an ML debugging assistant helping a student understand their model's issues.
+
+For the student's description below:
+
+1. Under "metrics", extract the following metrics if mentioned (null if not mentioned):
+- train_accuracy (percentage, 0-100)
+- test_accuracy (percentage, 0-100)
+- validation_accuracy (percentage, 0-100)
+- loss_oscillation ("high", "medium", "low", or null)
+- convergence_speed ("very_slow", "slow", "normal", "fast", or null)
+- dataset_size (number of samples)
+- batch_size (number)
+- learning_rate (decimal number)
+- epochs (number)
+
+2. Under "issues", list every issue that applies:
+""" + _ISSUE_GUIDE + """
+3. Under "explanation", give a clear, friendly explanation of those issues that summarizes the
+problem, explains WHY it happens and gives actionable next steps. Keep it concise (2-3 paragraphs)
+and encouraging.
+
+Student's description: "$user_query"
+""")
+
+# Prompt for speculative explanation
+_DRAFT_PROMPT = string.Template("""
+You are a friendly ML debugging assistant helping a student understand their model's issues.
+
+For the student's description below:
+
+1. Under "issues", list every issue that applies:
+""" + _ISSUE_GUIDE + """
+2. Under "explanation", provide a clear, friendly, and educational explanation of those issues that:
+- Summarizes the main problem in simple terms
+- Explains WHY this is happening
+- Gives actionable next steps
+- Includes a brief code example if relevant
+
+Keep it concise (2-3 paragraphs) and encouraging.
+
+Student's description: "$user_query"
+""")
+
+# Prompt for conversational clarification
+_CONV_PROMPT = string.Template("""
+You are an ML debugging assistant. The user is describing their model training issue.
+
+If the user hasn't provided enough information to diagnose the issue, ask ONE specific clarifying question about:
+- Training accuracy
+- Test/validation accuracy
+- Dataset size
+- Loss behavior (oscillating, plateauing, etc.)
+- Other relevant metrics
+
+If they've provided enough info, acknowledge and prepare to diagnose.
+Keep your response brief and friendly.
+$context_text
+User: "$user_message"
+""")
+
+
+class _CachedResponse:
+    """Stand-in for a Gemini response that was served from the cache"""
+
+    def __init__(self, text):
+        self.text = text
+
+
+class _TokenBucket:
+    """
+    Token-bucket rate limiter for requests and tokens per minute
+
+    Callers that would exceed the quota sleep until enough budget has been
+    refilled instead of getting a 429 from the API. Budget is reserved before
+    sleeping, so concurrent callers queue up behind each other. A limit of 0
+    leaves that quota unlimited.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.req_rate = rpm / 60.0
+        self.tok_rate = tpm / 60.0
+        self.req_capacity = rpm
+        self.tok_capacity = tpm
+        self.req_tokens = float(rpm)
+        self.tok_tokens = float(tpm)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, est_tokens):
+        """Block until one request using about est_tokens tokens may be sent"""
+        est_tokens = min(est_tokens, self.tok_capacity)
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._last
+            self._last = now
+
+            # Refill the buckets for the time that has passed and reserve this request
+            wait_time = 0.0
+            if self.req_rate:
+                self.req_tokens = min(self.req_capacity, self.req_tokens + elapsed * self.req_rate)
+                wait_time = max(wait_time, (1 - self.req_tokens) / self.req_rate)
+                self.req_tokens -= 1
+            if self.tok_rate:
+                self.tok_tokens = min(self.tok_capacity, self.tok_tokens + elapsed * self.tok_rate)
+                wait_time = max(wait_time, (est_tokens - self.tok_tokens) / self.tok_rate)
+                self.tok_tokens -= est_tokens
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class _CachedModel:
+    """
+    Exact-match response cache around a Gemini model
+
+    Responses are stored in SQLite keyed by SHA256 of (model, temperature, prompt),
+    together with the prompt and model so the cache can be inspected. Entries
+    with a TTL expire after `ttl` seconds (None keeps them forever).
+    Cache modes:
+        enabled    - serve hits from the cache, call the API and store on a miss
+        replay     - serve hits from the cache, never call the API
+        write-only - always call the API and store the response (warms a shared cache)
+        disabled   - always call the API
+    """
+
+    def __init__(self, model, model_name, temperature=None, path=CACHE_PATH, mode="enabled", limiter=None,
+                 ttl=None):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Invalid cache mode '{mode}' (expected one of {', '.join(CACHE_MODES)})")
+
+        self.model = model
+        self.model_name = model_name
+        self.temperature = temperature
+        self.mode = mode
+        self.limiter = limiter
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+        self._conn = None
+
+        if mode != "disabled":
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                self._conn = sqlite3.connect(path, check_same_thread=False)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._create_table()
+                self.prune()
+            except (OSError, sqlite3.Error) as e:
+                print(f"Response cache unavailable, continuing without it: {e}")
+                self._conn = None
+
+    def _create_table(self):
+        """Create the cache table if it does not exist yet"""
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache("
+            "key TEXT PRIMARY KEY, prompt TEXT, model TEXT, temperature REAL, "
+            "response TEXT, created_at REAL, ttl REAL)"
+        )
+        self._conn.commit()
+
+    def prune(self):
+        """Delete expired entries and return how many were removed"""
+        if self._conn is None:
+            return 0
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM cache WHERE ttl IS NOT NULL AND created_at + ttl < ?", (time.time(),)
+            )
+            self._conn.commit()
+        return cursor.rowcount
+
+    def _key(self, prompt, **kwargs):
+        """Cache key for a prompt (and any generation options that change the response)"""
+        raw = f"{self.model_name}|{self.temperature}|{prompt}"
+        if kwargs:
+            raw += "|" + json.dumps(kwargs, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def lookup(self, prompt, **kwargs):
+        """Return the cached (unexpired) response text for a prompt, or None"""
+        if self._conn is None or self.mode == "write-only":
+            return None
+        key = self._key(prompt, **kwargs)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM cache WHERE key=? AND (ttl IS NULL OR created_at + ttl >= ?)",
+                (key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def cached_text(self, prompt, **kwargs):
+        """Return the cached response text for a prompt (counted as a hit), or None"""
+        cached = self.lookup(prompt, **kwargs)
+        if cached is not None:
+            self.stats["hits"] += 1
+        return cached
+
+    def _miss(self):
+        """Count a cache miss, or fail in replay mode where the API may not be called"""
+        if self.mode == "replay":
+            if self._conn is None:
+                raise LookupError("Cache replay mode is on but the response cache is unavailable")
+            raise LookupError("Cache replay mode is on and this prompt has no cached response")
+        self.stats["misses"] += 1
+
+    def fetch(self, prompt, **kwargs):
+        """Call the API for a prompt the cache could not answer and store the response"""
+        self._miss()
+        response = self.call_api(prompt, **kwargs)
+        self._store(prompt, response.text, **kwargs)
+        return response
+
+    def fetch_stream(self, prompt, **kwargs):
+        """Streaming counterpart of fetch, yielding text chunks"""
+        self._miss()
+        parts = []
+        for chunk in self.call_api(prompt, stream=True, **kwargs):
+            parts.append(chunk.text)
+            yield chunk.text
+        self._store(prompt, "".join(parts), **kwargs)
+
+    def generate_content(self, prompt, **kwargs):
+        """Same interface as GenerativeModel.generate_content, served from the cache when possible"""
+        cached = self.cached_text(prompt, **kwargs)
+        if cached is not None:
+            return _CachedResponse(cached)
+        return self.fetch(prompt, **kwargs)
+
+    def stream_content(self, prompt, **kwargs):
+        """Yield the response text in chunks as it is generated (a cache hit is one chunk)"""
+        cached = self.cached_text(prompt, **kwargs)
+        if cached is not None:
+            yield cached
+            return
+        yield from self.fetch_stream(prompt, **kwargs)
+
+    def call_api(self, prompt, attempts=RETRY_ATTEMPTS, **kwargs):
+        """
+        Call the model directly (no cache), waiting for rate-limit budget first
+
+        Each attempt is bounded by REQUEST_TIMEOUT. Transient server errors are
+        counted in ERROR_COUNTS and retried with exponential backoff and full
+        jitter (capped at RETRY_MAX_WAIT) up to `attempts` times; any other
+        error is raised immediately.
+        """
+        kwargs.setdefault("request_options", {"timeout": REQUEST_TIMEOUT})
+        for attempt in range(attempts):
+            if self.limiter is not None:
+                self.limiter.acquire(len(prompt) // 4)
+            try:
+                return self.model.generate_content(prompt, **kwargs)
+            except TRANSIENT_ERRORS as e:
+                ERROR_COUNTS[type(e).__name__] += 1
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(random.uniform(0, min(RETRY_MAX_WAIT, 2 ** attempt)))
+
+    def _store(self, prompt, text, **kwargs):
+        """Save a response for a prompt"""
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache(key, prompt, model, temperature, response, created_at, ttl) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self._key(prompt, **kwargs), str(prompt), self.model_name, self.temperature,
+                 text, time.time(), self.ttl)
+            )
+            self._conn.commit()
+
+
+def _same_numbers(query, other):
+    """
+    Check that two queries mention the same numbers for the same metrics
+
+    "train 92 test 68" and "test 92 train 68" share a number sequence but swap
+    the metrics, so numbers the local patterns can label are compared as
+    (metric, value) pairs; queries they can't label unambiguously never match.
+    """
+    if _NUMBER_RE.findall(query) != _NUMBER_RE.findall(other):
+        return False
+    metrics = _metrics_local(query)
+    return metrics is not None and metrics == _metrics_local(other)
+
+
+class SemanticCache:
+    """
+    Embedding-based cache for paraphrased queries
+
+    Queries are embedded with a small local sentence-transformer and matched by
+    cosine similarity against earlier queries of the same kind. A stored response
+    is reused only if the similarity reaches the threshold and both queries
+    mention exactly the same numbers for the same metrics (so "92% train" never
+    matches "86% train" or "92% test"). Like the exact cache, entries expire
+    after `ttl` seconds (None keeps them forever).
+    """
+
+    def __init__(self, path=CACHE_PATH, threshold=SEMANTIC_THRESHOLD, model_name=EMBEDDING_MODEL, ttl=None):
+        if SentenceTransformer is None:
+            raise ImportError("The semantic cache requires numpy, faiss and sentence-transformers")
+
+        self.threshold = threshold
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0}
+        self._encoder = SentenceTransformer(model_name)
+        self._dim = self._encoder.get_sentence_embedding_dimension()
+        self._indexes = {}  # kind -> (faiss index, [(query, response)], earliest expiry time)
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_cache("
+            "id INTEGER PRIMARY KEY, kind TEXT, query TEXT, embedding BLOB, response TEXT, "
+            "created_at REAL, ttl REAL)"
+        )
+        # Tables created before entries could expire lack the expiry columns (their rows never expire)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(semantic_cache)")}
+        for column in ("created_at", "ttl"):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE semantic_cache ADD COLUMN {column} REAL")
+        self._conn.commit()
+        self.prune()
+
+    def prune(self):
+        """Delete expired entries and return how many were removed"""
+        with self._lock:
+            return self._prune()
+
+    def _prune(self):
+        """prune() for callers already holding the lock; indexes reload without the removed entries"""
+        cursor = self._conn.execute(
+            "DELETE FROM semantic_cache WHERE ttl IS NOT NULL AND created_at + ttl < ?", (time.time(),)
+        )
+        self._conn.commit()
+        if cursor.rowcount:
+            self._indexes.clear()
+        return cursor.rowcount
+
+    def _embed(self, text):
+        """Normalized float32 embedding, so inner product equals cosine similarity"""
+        return self._encoder.encode([text], normalize_embeddings=True).astype(np.float32)
+
+    def _index(self, kind):
+        """Load (or create) the in-memory index of unexpired entries for one kind of query"""
+        if kind not in self._indexes:
+            index = faiss.IndexFlatIP(self._dim)
+            entries = []
+            rows = self._conn.execute(
+                "SELECT query, embedding, response, created_at + ttl FROM semantic_cache "
+                "WHERE kind=? AND (ttl IS NULL OR created_at + ttl >= ?) ORDER BY id", (kind, time.time())
+            ).fetchall()
+            if rows:
+                index.add(np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in rows]))
+                entries = [(row[0], row[2]) for row in rows]
+            expires = min((row[3] for row in rows if row[3] is not None), default=float("inf"))
+            self._indexes[kind] = (index, entries, expires)
+        return self._indexes[kind]
+
+    def lookup(self, kind, query):
+        """Return a cached response for a paraphrase of the query, or None"""
+        vector = self._embed(query)
+        with self._lock:
+            index, entries, expires = self._index(kind)
+            if expires < time.time():
+                # An entry expired since the index was loaded
+                self._prune()
+                index, entries, expires = self._index(kind)
+            if index.ntotal:
+                scores, ids = index.search(vector, 1)
+                cached_query, response = entries[ids[0][0]]
+                if scores[0][0] >= self.threshold and _same_numbers(cached_query, query):
+                    self.stats["hits"] += 1
+                    return response
+            self.stats["misses"] += 1
+        return None
+
+    def store(self, kind, query, response):
+        """Remember the response for a query"""
+        vector = self._embed(query)
+        now = time.time()
+        with self._lock:
+            index, entries, expires = self._index(kind)
+            index.add(vector)
+            entries.append((query, response))
+            if self.ttl is not None:
+                self._indexes[kind] = (index, entries, min(expires, now + self.ttl))
+            self._conn.execute(
+                "INSERT INTO semantic_cache(kind, query, embedding, response, created_at, ttl) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, query, vector.tobytes(), response, now, self.ttl)
+            )
+            self._conn.commit()
+
+
 class GeminiIntegration:
     """Integration with Gemini API for NL processing"""
     
-    def __init__(self, api_key):
-        """Initialize Gemini API"""
+    def __init__(self, api_key, cache_ttl=None):
+        """
+        Initialize Gemini API
+        
+        Args:
+            api_key (str): Gemini API key
+            cache_ttl (float): Default lifetime of cached responses in seconds
+                (None keeps them; GEMINI_CACHE_TTL overrides)
+        """
         genai.configure(api_key=api_key)
-        # Use gemini-2.5-flash (fast and efficient for general tasks)
-        self.model = genai.GenerativeModel('models/gemini-2.5-flash')
+        model = genai.GenerativeModel(MODEL_NAME)
+        
+        # With a quota set, API calls wait for it instead of failing with 429 (retries count too)
+        rpm = max(0, int(os.getenv("GEMINI_RPM_LIMIT", RPM_LIMIT)))
+        tpm = max(0, int(os.getenv("GEMINI_TPM_LIMIT", TPM_LIMIT)))
+        limiter = _TokenBucket(rpm, tpm) if rpm or tpm else None
+        
+        # Repeated prompts are answered from the local cache
+        # (GEMINI_CACHE_MODE=enabled|replay|write-only|disabled, optional GEMINI_CACHE_TTL in seconds)
+        cache_path = os.path.expanduser(os.getenv("GEMINI_CACHE_PATH", CACHE_PATH))
+        cache_ttl_env = os.getenv("GEMINI_CACHE_TTL")
+        self.model = _CachedModel(
+            model,
+            MODEL_NAME,
+            path=cache_path,
+            mode=os.getenv("GEMINI_CACHE_MODE", "enabled").strip().lower(),
+            limiter=limiter,
+            ttl=float(cache_ttl_env) if cache_ttl_env else cache_ttl
+        )
+
+        # Paraphrased queries can be answered from the semantic cache (opt-in: GEMINI_SEMANTIC_CACHE=1)
+        self.semantic_cache = None
+        if os.getenv("GEMINI_SEMANTIC_CACHE") == "1" and self.model.mode in ("enabled", "replay"):
+            try:
+                self.semantic_cache = SemanticCache(
+                    path=cache_path,
+                    threshold=float(os.getenv("GEMINI_SEMANTIC_THRESHOLD", SEMANTIC_THRESHOLD)),
+                    ttl=self.model.ttl
+                )
+            except Exception as e:
+                print(f"Semantic cache unavailable, continuing without it: {e}")
+
+    def warmup(self):
+        """
+        Send a tiny request (bypassing the cache) so the connection and
+        credentials are ready before the first real query
+
+        A single short attempt: a slow network should not tie up the caller.
+        """
+        if self.model.mode == "replay":
+            return
+        try:
+            self.model.call_api("ok", attempts=1, request_options={"timeout": WARMUP_TIMEOUT})
+        except Exception:
+            # Warm-up is best effort; real calls report their own errors
+            pass
+
+    @property
+    def cache_stats(self):
+        """Cache hit/miss counters for display"""
+        stats = dict(self.model.stats)
+        if self.semantic_cache is not None:
+            stats["semantic_hits"] = self.semantic_cache.stats["hits"]
+        return stats
+
+    def _generate(self, prompt, kind, query, **kwargs):
+        """
+        Generate a response for a prompt
+
+        Exact-cache hits are served by self.model; otherwise a paraphrase of
+        `query` already answered for the same `kind` is reused when possible.
+        """
+        cached = self.model.cached_text(prompt, **kwargs)
+        if cached is not None:
+            return cached
+
+        if self.semantic_cache is None:
+            return self.model.fetch(prompt, **kwargs).text
+
+        cached = self.semantic_cache.lookup(kind, query)
+        if cached is not None:
+            return cached
+
+        text = self.model.fetch(prompt, **kwargs).text
+        self.semantic_cache.store(kind, query, text)
+        return text
+
+    def _generate_stream(self, prompt, kind, query):
+        """Streaming counterpart of _generate, yielding text chunks"""
+        cached = self.model.cached_text(prompt)
+        if cached is not None:
+            yield cached
+            return
+
+        if self.semantic_cache is None:
+            yield from self.model.fetch_stream(prompt)
+            return
+
+        cached = self.semantic_cache.lookup(kind, query)
+        if cached is not None:
+            yield cached
+            return
+
+        parts = []
+        for text in self.model.fetch_stream(prompt):
+            parts.append(text)
+            yield text
+        self.semantic_cache.store(kind, query, "".join(parts))
+    
+    def extract_metrics_locally(self, user_query):
+        """
+        Extract ML metrics from a simple query without calling Gemini
+        
+        Args:
+            user_query (str): User's natural language question
+            
+        Returns:
+            dict: Extracted metrics, or {} if the query needs the LLM
+        """
+        metrics = _extract_local(user_query)
+        return metrics if len(metrics) >= 2 else {}
     
     def extract_metrics(self, user_query):
         """
@@ -37,38 +846,19 @@ class GeminiIntegration:
         Returns:
             dict: Extracted metrics
         """
-        prompt = f"""
-You are an expert at extracting ML training metrics from natural language descriptions.
-
-User Query: "{user_query}"
-
-Extract the following metrics if mentioned (return null if not mentioned):
-- train_accuracy (percentage, 0-100)
-- test_accuracy (percentage, 0-100) 
-- validation_accuracy (percentage, 0-100)
-- loss_oscillation ("high", "medium", "low", or null)
-- convergence_speed ("very_slow", "slow", "normal", "fast", or null)
-- dataset_size (number of samples)
-- batch_size (number)
-- learning_rate (decimal number)
-- epochs (number)
-
-Return ONLY a valid JSON object with these fields. Use null for missing values.
-Example: {{"train_accuracy": 95, "test_accuracy": 70, "dataset_size": null, "batch_size": null}}
-"""
+        # Simple queries are handled locally without calling Gemini
+        metrics = self.extract_metrics_locally(user_query)
+        if metrics:
+            return metrics
+        
+        prompt = _EXTRACT_PROMPT.substitute(user_query=user_query)
         
         try:
-            response = self.model.generate_content(prompt)
-            text = response.text.strip()
-            
-            # Extract JSON from response (handle markdown code blocks)
-            json_match = re.search(r'\{[^}]+\}', text, re.DOTALL)
-            if json_match:
-                metrics = json.loads(json_match.group())
-                # Remove null values
-                return {k: v for k, v in metrics.items() if v is not None}
-            else:
-                return {}
+            # Structured output mode guarantees a JSON object matching the schema
+            text = self._generate(prompt, "extract", user_query, generation_config=_EXTRACT_CONFIG)
+            metrics = _parse_json(text)
+            # Remove null values
+            return {k: v for k, v in metrics.items() if v is not None}
         except Exception as e:
             print(f"Error extracting metrics: {e}")
             return {}
@@ -87,32 +877,101 @@ Example: {{"train_accuracy": 95, "test_accuracy": 70, "dataset_size": null, "bat
         diagnoses = "\n".join(diagnosis_results.get("diagnoses", []))
         recommendations = "\n".join([f"- {r}" for r in diagnosis_results.get("recommendations", [])])
         
-        prompt = f"""
-You are a friendly ML debugging assistant helping a student understand their model's issues.
-
-Original Question: "{user_query}"
-
-Expert System Diagnosis:
-{diagnoses}
-
-Recommendations:
-{recommendations}
-
-Provide a clear, friendly, and educational explanation that:
-1. Summarizes the main problem in simple terms
-2. Explains WHY this is happening
-3. Gives actionable next steps
-4. Includes a brief code example if relevant
-
-Keep it concise (2-3 paragraphs) and encouraging.
-"""
+        prompt = _EXPLAIN_PROMPT.substitute(user_query=user_query, diagnoses=diagnoses, recommendations=recommendations)
         
         try:
-            response = self.model.generate_content(prompt)
-            return response.text.strip()
+            kind = "explain:" + hashlib.sha256(f"{diagnoses}|{recommendations}".encode()).hexdigest()
+            return self._generate(prompt, kind, user_query).strip()
         except Exception as e:
             return f"Error generating explanation: {e}"
     
+    def generate_explanation_stream(self, diagnosis_results, user_query):
+        """
+        Streaming variant of generate_explanation
+        
+        Args:
+            diagnosis_results (dict): Results from expert system
+            user_query (str): Original user query
+            
+        Yields:
+            str: Pieces of the friendly explanation as they are generated
+        """
+        diagnoses = "\n".join(diagnosis_results.get("diagnoses", []))
+        recommendations = "\n".join([f"- {r}" for r in diagnosis_results.get("recommendations", [])])
+        
+        prompt = _EXPLAIN_PROMPT.substitute(user_query=user_query, diagnoses=diagnoses, recommendations=recommendations)
+        
+        try:
+            kind = "explain:" + hashlib.sha256(f"{diagnoses}|{recommendations}".encode()).hexdigest()
+            yield from self._generate_stream(prompt, kind, user_query)
+        except Exception as e:
+            yield f"Error generating explanation: {e}"
+    
+    def extract_and_explain(self, user_query):
+        """
+        Extract ML metrics and draft an explanation in a single request
+        
+        Args:
+            user_query (str): User's natural language question
+            
+        Returns:
+            tuple: (extracted metrics dict, draft dict or None - see draft_explanation)
+        """
+        # Simple queries are handled locally; the caller then explains the diagnosis
+        metrics = self.extract_metrics_locally(user_query)
+        if metrics:
+            return metrics, None
+        
+        prompt = _EXTRACT_AND_EXPLAIN_PROMPT.substitute(user_query=user_query)
+        
+        try:
+            text = self._generate(prompt, "extract_explain", user_query,
+                                  generation_config=_draft_config(with_metrics=True))
+            result = _parse_json(text)
+            metrics = {k: v for k, v in (result.pop("metrics", None) or {}).items() if v is not None}
+            return metrics, result if result.get("explanation") else None
+        except Exception as e:
+            print(f"Error extracting metrics: {e}")
+            return {}, None
+    
+    def draft_explanation(self, user_query):
+        """
+        Draft a friendly explanation straight from the user's description,
+        before the expert system has run (used speculatively)
+        
+        Args:
+            user_query (str): User's natural language question
+            
+        Returns:
+            dict: {"issues": [issue labels], "explanation": str}, or None if the request failed
+        """
+        prompt = _DRAFT_PROMPT.substitute(user_query=user_query)
+        
+        try:
+            result = _parse_json(self._generate(prompt, "draft", user_query, generation_config=_draft_config()))
+            return result if result.get("explanation") else None
+        except Exception as e:
+            print(f"Error drafting explanation: {e}")
+            return None
+    
+    def explanation_matches(self, draft, diagnosis_results):
+        """
+        Check whether a draft found exactly the issues the expert system diagnosed
+        
+        Args:
+            draft (dict): Draft from draft_explanation or extract_and_explain
+            diagnosis_results (dict): Results from expert system
+            
+        Returns:
+            bool: True if the draft's issues equal the diagnosed issues
+        """
+        diagnoses = diagnosis_results.get("diagnoses", [])
+        if not draft or not diagnoses:
+            return False
+        
+        expected = {_ISSUE_LABELS.get(diagnosis.split(":")[0]) for diagnosis in diagnoses}
+        return set(draft.get("issues") or []) == expected
+    
     def conversational_query(self, user_message, context=None):
         """
         Handle conversational queries for clarification
@@ -124,29 +983,48 @@ Keep it concise (2-3 paragraphs) and encouraging.
         Returns:
             str: Response
         """
-        context_text = f"\n\nPrevious context:\n{context}" if context else ""
+        context_text = f"\nPrevious context:\n{context}\n" if context else ""
         
-        prompt = f"""
-You are an ML debugging assistant. The user is describing their model training issue.
-
-User: "{user_message}"{context_text}
-
-If the user hasn't provided enough information to diagnose the issue, ask ONE specific clarifying question about:
-- Training accuracy
-- Test/validation accuracy  
-- Dataset size
-- Loss behavior (oscillating, plateauing, etc.)
-- Other relevant metrics
-
-If they've provided enough info, acknowledge and prepare to diagnose.
-Keep your response brief and friendly.
-"""
+        prompt = _CONV_PROMPT.substitute(user_message=user_message, context_text=context_text)
         
         try:
-            response = self.model.generate_content(prompt)
-            return response.text.strip()
+            kind = "chat:" + hashlib.sha256((context or "").encode()).hexdigest()
+            return self._generate(prompt, kind, user_message).strip()
         except Exception as e:
             return f"Error in conversation: {e}"
+    
+    def stream_conversational_query(self, user_message, context=None):
+        """
+        Streaming variant of conversational_query
+        
+        Args:
+            user_message (str): User's message
+            context (str): Previous conversation context
+            
+        Yields:
+            str: Pieces of the response as they are generated
+        """
+        context_text = f"\nPrevious context:\n{context}\n" if context else ""
+        
+        prompt = _CONV_PROMPT.substitute(user_message=user_message, context_text=context_text)
+        
+        try:
+            kind = "chat:" + hashlib.sha256((context or "").encode()).hexdigest()
+            yield from self._generate_stream(prompt, kind, user_message)
+        except Exception as e:
+            yield f"Error in conversation: {e}"
+    
+    # Async variants: each call runs in a worker thread (the GIL is released
+    # while it waits on the network), so several prompts can be awaited together
+    # with asyncio.gather.
+    
+    async def extract_metrics_async(self, user_query):
+        """Async variant of extract_metrics"""
+        return await asyncio.to_thread(self.extract_metrics, user_query)
+    
+    async def draft_explanation_async(self, user_query):
+        """Async variant of draft_explanation"""
+        return await asyncio.to_thread(self.draft_explanation, user_query)
 
 
 # Example usage
@@ -20,13 +20,23 @@ except ImportError as e:
     sys.exit(1)
 
 from ml_debugging_expert import run_diagnosis
-from gemini_integration import GeminiIntegration
-import threading
 import os
-from dotenv import load_dotenv
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+def load_env():
+    """Load variables from a .env file unless the API key is already set"""
+    if os.getenv("GEMINI_API_KEY"):
+        return
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        # Without python-dotenv we rely on the environment variables
+        pass
 
-# Load environment variables
-load_dotenv()
 
 class MLDebugGUI:
     """Simple GUI for ML debugging expert system"""
@@ -40,6 +50,14 @@ class MLDebugGUI:
         self.gemini = None
         self.api_key = None
         
+        # Persistent workers for background work (reused across clicks)
+        self.pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="diag")
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        
+        # Workers post (action, args) UI updates here; the Tk thread applies them in order
+        self.ui_queue = queue.Queue()
+        self.root.after(50, self.drain_queue)
+        
         # Modern Color Palette - accessible throughout the class
         self.colors = {
             'primary': '#2563eb',      # Modern blue
@@ -53,32 +71,45 @@ class MLDebugGUI:
         }
         
         # Try to load API key from environment
+        load_env()
         self.env_api_key = (
             os.getenv("GEMINI_API_KEY")
             or os.getenv("GOOGLE_API_KEY")
             or os.getenv("API_KEY")
         )
         
+        # Import the Gemini SDK in the background so the window appears immediately
+        self.pool.submit(self.preload_gemini)
+        
         self.setup_ui()
         
         # Auto-connect if API key is in environment
         if self.env_api_key:
             self.api_entry.insert(0, "●" * 20 + " (from .env)")
             self.api_entry.config(state='disabled')
-            self.connect_api()
+            # Connect once the window is on screen
+            self.root.after(100, self.connect_api)
     
     def setup_ui(self):
         """Setup the user interface"""
+        # Bind palette colors once instead of looking them up for every widget
+        colors = self.colors
+        text_color = colors['text']
+        primary = colors['primary']
+        success = colors['success']
+        danger = colors['danger']
+        dark = colors['dark']
+        light = colors['light']
         
         # Title Frame - Modern gradient-like effect
-        title_frame = tk.Frame(self.root, bg=self.colors['dark'], height=100)
+        title_frame = tk.Frame(self.root, bg=dark, height=100)
         title_frame.pack(fill=tk.X, pady=0)
         
         title_label = tk.Label(
             title_frame,
             text="🤖 ML Model Debugging Expert System",
             font=("Helvetica", 22, "bold"),
-            bg=self.colors['dark'],
+            bg=dark,
             fg="white"
         )
         title_label.pack(pady=(25, 5))
@@ -87,22 +118,22 @@ class MLDebugGUI:
             title_frame,
             text="Hybrid AI: Expert System + Gemini LLM",
             font=("Helvetica", 12),
-            bg=self.colors['dark'],
+            bg=dark,
             fg="#94a3b8"
         )
         subtitle_label.pack(pady=(0, 20))
         
         # Main container with two columns
-        main_container = tk.Frame(self.root, bg=self.colors['light'])
+        main_container = tk.Frame(self.root, bg=light)
         main_container.pack(fill=tk.BOTH, expand=True, padx=25, pady=25)
         
         # LEFT SIDE - Input Panel
-        left_panel = tk.Frame(main_container, bg=self.colors['light'])
+        left_panel = tk.Frame(main_container, bg=light)
         left_panel.pack(side=tk.LEFT, fill=tk.BOTH, expand=False, padx=(0, 10))
         left_panel.config(width=500)
         
         # RIGHT SIDE - Output Panel
-        right_panel = tk.Frame(main_container, bg=self.colors['light'])
+        right_panel = tk.Frame(main_container, bg=light)
         right_panel.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=(10, 0))
         
         # === LEFT PANEL CONTENT ===
@@ -113,7 +144,7 @@ class MLDebugGUI:
             text=" 🔑 Gemini API Connection ",
             font=("Helvetica", 12, "bold"),
             bg="white",
-            fg=self.colors['text'],
+            fg=text_color,
             relief=tk.FLAT,
             bd=2
         )
@@ -124,7 +155,7 @@ class MLDebugGUI:
             text="API Key:",
             font=("Helvetica", 11),
             bg="white",
-            fg=self.colors['text'],
+            fg=text_color,
             anchor=tk.W
         ).grid(row=0, column=0, sticky=tk.W, padx=10, pady=5)
         
@@ -143,7 +174,7 @@ class MLDebugGUI:
             text="🔌 Connect API",
             command=self.connect_api,
             font=("Helvetica", 11, "bold"),
-            bg=self.colors['success'],
+            bg=success,
             fg="white",
             relief=tk.FLAT,
             cursor="hand2",
@@ -157,7 +188,7 @@ class MLDebugGUI:
             text="⚠️ Not Connected",
             font=("Helvetica", 10),
             bg="white",
-            fg=self.colors['danger']
+            fg=danger
         )
         self.api_status.grid(row=1, column=0, columnspan=3, pady=5)
         
@@ -167,7 +198,7 @@ class MLDebugGUI:
             text="📋 Select Input Mode",
             font=("Helvetica", 12, "bold"),
             bg="white",
-            fg=self.colors['text'],
+            fg=text_color,
             relief=tk.FLAT,
             borderwidth=2,
             padx=15,
@@ -183,10 +214,10 @@ class MLDebugGUI:
             variable=self.mode_var,
             value="natural",
             bg="white",
-            fg=self.colors['text'],
+            fg=text_color,
             font=("Helvetica", 11),
             activebackground="white",
-            selectcolor=self.colors['primary'],
+            selectcolor=primary,
             command=self.switch_mode
         ).pack(anchor="w", pady=5)
         
@@ -196,10 +227,10 @@ class MLDebugGUI:
             variable=self.mode_var,
             value="structured",
             bg="white",
-            fg=self.colors['text'],
+            fg=text_color,
             font=("Helvetica", 11),
             activebackground="white",
-            selectcolor=self.colors['primary'],
+            selectcolor=primary,
             command=self.switch_mode
         ).pack(anchor="w", pady=5)
         
@@ -209,7 +240,7 @@ class MLDebugGUI:
             text="📝 Input",
             font=("Helvetica", 12, "bold"),
             bg="white",
-            fg=self.colors['text'],
+            fg=text_color,
             relief=tk.FLAT,
             borderwidth=2,
             padx=15,
@@ -224,7 +255,7 @@ class MLDebugGUI:
             self.natural_frame,
             text="Describe your ML training issue:",
             bg="white",
-            fg=self.colors['text'],
+            fg=text_color,
             font=("Helvetica", 11, "bold")
         ).pack(anchor="w", pady=(0, 8))
         
@@ -257,7 +288,7 @@ class MLDebugGUI:
                 self.structured_frame, 
                 text=label, 
                 bg="white",
-                fg=self.colors['text'],
+                fg=text_color,
                 font=("Helvetica", 11)
             ).grid(row=i, column=0, sticky="w", padx=5, pady=8)
             
@@ -276,7 +307,7 @@ class MLDebugGUI:
             self.structured_frame, 
             text="Loss Oscillation:", 
             bg="white",
-            fg=self.colors['text'],
+            fg=text_color,
             font=("Helvetica", 11)
         ).grid(row=4, column=0, sticky="w", padx=5, pady=8)
         
@@ -296,7 +327,7 @@ class MLDebugGUI:
             self.structured_frame, 
             text="Convergence Speed:", 
             bg="white",
-            fg=self.colors['text'],
+            fg=text_color,
             font=("Helvetica", 11)
         ).grid(row=5, column=0, sticky="w", padx=5, pady=8)
         
@@ -319,7 +350,7 @@ class MLDebugGUI:
             left_panel,
             text="🔍 Diagnose Issue",
             command=self.diagnose,
-            bg=self.colors['primary'],
+            bg=primary,
             fg="white",
             font=("Helvetica", 14, "bold"),
             cursor="hand2",
@@ -338,7 +369,7 @@ class MLDebugGUI:
             text="💡 Diagnosis & Recommendations",
             font=("Helvetica", 12, "bold"),
             bg="white",
-            fg=self.colors['text'],
+            fg=text_color,
             relief=tk.FLAT,
             borderwidth=2,
             padx=15,
@@ -352,7 +383,7 @@ class MLDebugGUI:
             font=("Helvetica", 11),
             wrap=tk.WORD,
             bg="#fafafa",
-            fg=self.colors['text'],
+            fg=text_color,
             relief=tk.SOLID,
             borderwidth=1,
             padx=12,
@@ -362,6 +393,30 @@ class MLDebugGUI:
         self.output_text.insert("1.0", "👆 Connect to API and describe your issue to get started!\n\nThe system will analyze your ML training problem and provide:\n  • Expert system diagnosis\n  • Detailed recommendations\n  • Friendly AI-generated explanations")
         self.output_text.config(state=tk.DISABLED)
     
+    def post(self, action, *args):
+        """Queue a UI update from a worker thread"""
+        self.ui_queue.put((action, args))
+    
+    def drain_queue(self):
+        """Apply queued UI updates (runs on the Tk thread every 50 ms)"""
+        try:
+            while True:
+                action, args = self.ui_queue.get_nowait()
+                action(*args)
+        except queue.Empty:
+            pass
+        finally:
+            self.root.after(50, self.drain_queue)
+    
+    def on_close(self):
+        """Stop background workers, close the window and exit"""
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.root.destroy()
+        # A worker stuck in a Gemini call can't be interrupted, and the executor's
+        # exit hook would wait for it, so leave without joining the workers
+        sys.stdout.flush()
+        os._exit(0)
+    
     def switch_mode(self):
         """Switch between natural language and structured input"""
         mode = self.mode_var.get()
@@ -376,6 +431,14 @@ class MLDebugGUI:
         else:
             self.structured_frame.pack(fill=tk.BOTH, expand=True)
     
+    def preload_gemini(self):
+        """Import the Gemini integration ahead of the first connect"""
+        try:
+            import gemini_integration  # noqa: F401
+        except Exception:
+            # Import errors are reported by connect_api
+            pass
+    
     def connect_api(self):
         """Connect to Gemini API"""
         # Use environment key if available, otherwise get from entry field
@@ -389,8 +452,14 @@ class MLDebugGUI:
             return
         
         try:
+            from gemini_integration import GeminiIntegration
+            
             self.gemini = GeminiIntegration(api_key)
             self.api_key = api_key
+            
+            # Open the connection now so the first diagnosis doesn't pay the cold start
+            self.pool.submit(self.gemini.warmup)
+            
             self.api_status.config(text="✅ Connected", fg=self.colors['success'])
             self.connect_btn.config(state=tk.DISABLED, bg="#6b7280")
             self.diagnose_btn.config(state=tk.NORMAL, bg=self.colors['primary'])
@@ -411,19 +480,13 @@ class MLDebugGUI:
         
         # Disable button during processing
         self.diagnose_btn.config(state=tk.DISABLED, text="⏳ Processing...")
-        self.output_text.config(state=tk.NORMAL)
-        self.output_text.delete("1.0", tk.END)
-        self.output_text.insert("1.0", "⏳ Analyzing your issue...\n\n")
-        self.output_text.config(state=tk.DISABLED)
+        self.update_output("⏳ Analyzing your issue...\n\n", done=False)
         
-        # Run diagnosis in separate thread to avoid freezing
+        # Run diagnosis on a worker thread to avoid freezing
         if mode == "natural":
-            thread = threading.Thread(target=self.diagnose_natural)
+            self.pool.submit(self.diagnose_natural)
         else:
-            thread = threading.Thread(target=self.diagnose_structured)
-        
-        thread.daemon = True
-        thread.start()
+            self.pool.submit(self.diagnose_structured)
     
     def diagnose_natural(self):
         """Diagnose using natural language input"""
@@ -434,8 +497,8 @@ class MLDebugGUI:
                 self.show_error("Please describe your ML training issue!")
                 return
             
-            # Extract metrics
-            metrics = self.gemini.extract_metrics(query)
+            # Extract metrics and draft an explanation in a single request
+            metrics, draft = self.gemini.extract_and_explain(query)
             
             if not metrics:
                 self.show_error("Could not extract metrics from your description. Please provide more details!")
@@ -444,11 +507,16 @@ class MLDebugGUI:
             # Run expert system
             results = run_diagnosis(metrics)
             
-            # Generate explanation
-            explanation = self.gemini.generate_explanation(results, query)
+            # Keep the draft if it found the same issues, otherwise explain the diagnosis
+            if self.gemini.explanation_matches(draft, results):
+                self.display_results(results, draft["explanation"], metrics)
+                return
             
-            # Display results
-            self.display_results(results, explanation, metrics)
+            # Show the diagnosis now and stream the explanation in as it is generated
+            self.display_results(results, None, metrics, streaming=True)
+            for chunk in self.gemini.generate_explanation_stream(results, query):
+                self.post(self.append_output, chunk)
+            self.post(self.append_output, "\n\n" + "=" * 60 + "\n", True)
             
         except Exception as e:
             self.show_error(f"Error during diagnosis: {str(e)}")
@@ -493,53 +561,65 @@ class MLDebugGUI:
         except Exception as e:
             self.show_error(f"Error during diagnosis: {str(e)}")
     
-    def display_results(self, results, explanation, metrics):
-        """Display diagnosis results"""
-        output = "=" * 60 + "\n"
-        output += "📊 EXTRACTED METRICS\n"
-        output += "=" * 60 + "\n"
+    def display_results(self, results, explanation, metrics, streaming=False):
+        """Display diagnosis results (with streaming=True the explanation is appended later)"""
+        rule = "=" * 60 + "\n"
+        parts = [rule, "📊 EXTRACTED METRICS\n", rule]
         for key, value in metrics.items():
-            output += f"  • {key}: {value}\n"
+            parts.append(f"  • {key}: {value}\n")
         
-        output += "\n" + "=" * 60 + "\n"
-        output += "🔍 EXPERT SYSTEM DIAGNOSIS\n"
-        output += "=" * 60 + "\n"
+        parts += ["\n", rule, "🔍 EXPERT SYSTEM DIAGNOSIS\n", rule]
         
         if results["diagnoses"]:
             for diagnosis in results["diagnoses"]:
-                output += f"\n{diagnosis}\n"
+                parts.append(f"\n{diagnosis}\n")
         else:
-            output += "\n⚠️ No specific issues detected with provided metrics.\n"
+            parts.append("\n⚠️ No specific issues detected with provided metrics.\n")
         
-        output += "\n" + "=" * 60 + "\n"
-        output += "📋 RECOMMENDATIONS\n"
-        output += "=" * 60 + "\n"
+        parts += ["\n", rule, "📋 RECOMMENDATIONS\n", rule]
         
         for i, rec in enumerate(results["recommendations"], 1):
-            output += f"\n{i}. {rec}\n"
+            parts.append(f"\n{i}. {rec}\n")
         
-        if explanation:
-            output += "\n" + "=" * 60 + "\n"
-            output += "💡 FRIENDLY EXPLANATION\n"
-            output += "=" * 60 + "\n"
-            output += f"\n{explanation}\n"
+        if explanation or streaming:
+            parts += ["\n", rule, "💡 FRIENDLY EXPLANATION\n", rule]
         
-        output += "\n" + "=" * 60 + "\n"
+        if streaming:
+            parts.append("\n")
+        else:
+            if explanation:
+                parts.append(f"\n{explanation}\n")
+            parts += ["\n", rule]
         
-        self.root.after(0, lambda: self.update_output(output))
+        self.post(self.update_output, "".join(parts), not streaming)
     
-    def update_output(self, text):
+    def update_output(self, text, done=True):
         """Update output text (thread-safe)"""
+        # Swap the whole document in one edit so the widget re-lays out only once
         self.output_text.config(state=tk.NORMAL)
-        self.output_text.delete("1.0", tk.END)
-        self.output_text.insert("1.0", text)
+        self.output_text.replace("1.0", tk.END, text)
+        self.output_text.see("1.0")
         self.output_text.config(state=tk.DISABLED)
+        if done:
+            self.reset_diagnose_btn()
+    
+    def append_output(self, text, done=False):
+        """Append streamed text to the output"""
+        # Only the new chunk is inserted, not the whole document
+        self.output_text.config(state=tk.NORMAL)
+        self.output_text.insert(tk.END, text)
+        self.output_text.config(state=tk.DISABLED)
+        if done:
+            self.reset_diagnose_btn()
+    
+    def reset_diagnose_btn(self):
+        """Re-enable the diagnose button after a run"""
         self.diagnose_btn.config(state=tk.NORMAL, text="🔍 Diagnose Issue")
     
     def show_error(self, message):
         """Show error message (thread-safe)"""
-        self.root.after(0, lambda: messagebox.showerror("Error", message))
-        self.root.after(0, lambda: self.diagnose_btn.config(state=tk.NORMAL, text="🔍 Diagnose Issue"))
+        self.post(messagebox.showerror, "Error", message)
+        self.post(self.reset_diagnose_btn)
 
 
 def main():
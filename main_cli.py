@@ -3,18 +3,29 @@ ML Debugging Expert System - Main CLI Interface
 Interactive command-line interface for the hybrid expert system
 """
 
+import asyncio
+import collections
+import queue
 import sys
-
-from ml_debugging_expert import run_diagnosis
-from gemini_integration import GeminiIntegration
+import threading
 import json
 
+# Cached Gemini answers expire after a day (FAQ-style reuse of repeated questions)
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+
+# Most recent (user, assistant) turns passed back to Gemini as context
+MAX_CONTEXT_TURNS = 20
+
 class MLDebugCLI:
     """Command-line interface for ML debugging"""
     
     def __init__(self, api_key):
-        self.gemini = GeminiIntegration(api_key)
+        # Imported here so the menu comes up without loading the Gemini SDK at import time
+        from gemini_integration import GeminiIntegration
+        
+        self.gemini = GeminiIntegration(api_key, cache_ttl=RESPONSE_CACHE_TTL)
         self.mode = None
+        self.warmed_up = False
     
     def print_header(self):
         """Print welcome header"""
@@ -46,7 +57,7 @@ class MLDebugCLI:
             return
         
         print("\n⏳ Extracting metrics from your query...")
-        metrics = self.gemini.extract_metrics(query)
+        metrics, draft = asyncio.run(self.extract_with_draft(query))
         
         if not metrics:
             print("❌ Could not extract metrics. Please try again with more details.")
@@ -55,6 +66,7 @@ class MLDebugCLI:
         print(f"✅ Extracted metrics: {json.dumps(metrics, indent=2)}")
         
         print("\n⏳ Running expert system diagnosis...")
+        from ml_debugging_expert import run_diagnosis
         results = run_diagnosis(metrics)
         
         print("\n" + "=" * 70)
@@ -63,15 +75,41 @@ class MLDebugCLI:
         for diagnosis in results["diagnoses"]:
             print(f"• {diagnosis}")
         
-        print("\n⏳ Generating friendly explanation...")
-        explanation = self.gemini.generate_explanation(results, query)
+        # Keep the draft if it found the same issues, otherwise explain the diagnosis
+        if self.gemini.explanation_matches(draft, results):
+            pieces = [draft["explanation"]]
+        else:
+            print("\n⏳ Generating friendly explanation...")
+            pieces = self.gemini.generate_explanation_stream(results, query)
         
         print("\n" + "=" * 70)
         print("💡 EXPLANATION & RECOMMENDATIONS")
         print("=" * 70)
-        print(explanation)
+        self.print_stream(pieces)
         print("=" * 70)
     
+    def print_stream(self, pieces):
+        """Print text pieces as they arrive and return the full text"""
+        parts = []
+        for piece in pieces:
+            sys.stdout.write(piece)
+            sys.stdout.flush()
+            parts.append(piece)
+        print()
+        return "".join(parts).strip()
+    
+    async def extract_with_draft(self, query):
+        """Extract metrics, drafting an explanation speculatively while Gemini extracts them"""
+        # Locally extracted metrics are diagnosed at once, so there is nothing to overlap
+        metrics = self.gemini.extract_metrics_locally(query)
+        if metrics:
+            return metrics, None
+        
+        return await asyncio.gather(
+            self.gemini.extract_metrics_async(query),
+            self.gemini.draft_explanation_async(query)
+        )
+    
     def structured_mode(self):
         """Handle structured metric input"""
         print("\n📊 STRUCTURED INPUT MODE")
@@ -114,6 +152,7 @@ class MLDebugCLI:
             return
         
         print("\n⏳ Running diagnosis...")
+        from ml_debugging_expert import run_diagnosis
         results = run_diagnosis(metrics)
         
         print("\n" + "=" * 70)
@@ -136,20 +175,36 @@ class MLDebugCLI:
         print("Chat with the system to diagnose your issue.")
         print("Type 'done' when you've provided all information.\n")
         
-        context = ""
+        history = collections.deque(maxlen=MAX_CONTEXT_TURNS)  # oldest turns drop off
         conversation = []
+        lines = queue.Queue()
+        
+        def read_line():
+            """Read one line of stdin in the background (EOF ends the chat)"""
+            try:
+                lines.put(input())
+            except EOFError:
+                lines.put("done")
+        
+        # Warm up the Gemini connection (once per session) while the user types their first message
+        if not self.warmed_up:
+            self.warmed_up = True
+            threading.Thread(target=self.gemini.warmup, daemon=True).start()
+        threading.Thread(target=read_line, daemon=True).start()
         
         while True:
-            user_input = input("You: ").strip()
+            print("You: ", end="", flush=True)
+            user_input = lines.get().strip()
             
             if user_input.lower() == 'done':
                 print("\n⏳ Analyzing conversation for diagnosis...")
                 
                 # Combine conversation
-                full_context = " ".join([msg for msg in conversation])
+                full_context = " ".join(conversation)
                 metrics = self.gemini.extract_metrics(full_context)
                 
                 if metrics:
+                    from ml_debugging_expert import run_diagnosis
                     results = run_diagnosis(metrics)
                     print("\n" + "=" * 70)
                     print("🔍 FINAL DIAGNOSIS")
@@ -165,11 +220,24 @@ class MLDebugCLI:
                     print("❌ Not enough information gathered for diagnosis.")
                 break
             
+            # Start reading the next message so the user can type while the reply streams
+            threading.Thread(target=read_line, daemon=True).start()
+            
             conversation.append(user_input)
-            response = self.gemini.conversational_query(user_input, context)
-            print(f"\nAssistant: {response}\n")
+            print("\nAssistant: ", end="", flush=True)
+            context = "\n".join(f"User: {u}\nAssistant: {a}" for u, a in history)
+            response = self.print_stream(self.gemini.stream_conversational_query(user_input, context))
+            print()
             
-            context += f"\nUser: {user_input}\nAssistant: {response}"
+            history.append((user_input, response))
+    
+    def print_error_summary(self):
+        """Report transient Gemini API errors (rate limits, timeouts) seen this session"""
+        from gemini_integration import ERROR_COUNTS
+        
+        if ERROR_COUNTS:
+            summary = ", ".join(f"{name} x{count}" for name, count in ERROR_COUNTS.most_common())
+            print(f"\n⚠️  Gemini API errors this session (retried): {summary}")
     
     def run(self):
         """Main execution loop"""
@@ -186,6 +254,7 @@ class MLDebugCLI:
             elif choice == "3":
                 self.conversational_mode()
             elif choice == "4":
+                self.print_error_summary()
                 print("\n👋 Thank you for using ML Debugging Expert System!")
                 print("=" * 70)
                 sys.exit(0)
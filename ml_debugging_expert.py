@@ -3,134 +3,281 @@ ML Debugging Expert System
 Core expert system with rules for diagnosing ML training issues
 """
 
-# Ensure backwards compatibility for older packages that reference
-# `collections.Mapping` on newer Python versions (Mapping moved to
-# `collections.abc`). The `compat` module provides aliases when
-# necessary and must be imported before importing `experta`.
-import compat  # noqa: F401 (module side-effects)
-from experta import *
 import json
+import os
+import threading
 
-class MLMetrics(Fact):
-    """Fact to store ML training metrics"""
-    pass
 
-class MLDebugExpert(KnowledgeEngine):
-    """Expert system for diagnosing ML training issues"""
+# Rule thresholds, shared by the rules below and the issue guide given to Gemini
+THRESHOLDS = {
+    "overfit_gap": 15,      # train - test accuracy gap above which the model overfits
+    "underfit_train": 70,   # train accuracy below which (with a small gap) the model underfits
+    "underfit_gap": 10,
+    "good_train": 85,       # minimum accuracies and maximum gap for a good model
+    "good_test": 80,
+    "good_gap": 10,
+    "small_dataset": 1000,  # sample count below which the dataset is too small
+    "small_batch": 16,      # batch size below which gradients are noisy on larger datasets
+}
+
+
+# Rule predicates, defined once at import and shared by every engine run.
+# acc_gap (train - test accuracy) is computed in run_diagnosis before declaring facts.
+def _gap_overfit(gap):
+    return gap > THRESHOLDS["overfit_gap"]
+
+def _gap_underfit(gap):
+    return abs(gap) < THRESHOLDS["underfit_gap"]
+
+def _gap_good(gap):
+    return abs(gap) <= THRESHOLDS["good_gap"]
+
+def _train_underfit(value):
+    return value < THRESHOLDS["underfit_train"]
+
+def _train_good(value):
+    return value >= THRESHOLDS["good_train"]
+
+def _test_good(value):
+    return value >= THRESHOLDS["good_test"]
+
+def _dataset_small(value):
+    return value < THRESHOLDS["small_dataset"]
+
+def _dataset_large(value):
+    return value > THRESHOLDS["small_dataset"]
+
+def _batch_small(value):
+    return value < THRESHOLDS["small_batch"]
+
+
+# Diagnosis message for each rule, keyed by the issue it declares; filled in from the metrics
+DIAG_TEMPLATES = {
+    "overfitting": "OVERFITTING DETECTED: Train accuracy ({train_accuracy}%) significantly higher than test accuracy ({test_accuracy}%)",
+    "underfitting": "UNDERFITTING DETECTED: Both train ({train_accuracy}%) and test ({test_accuracy}%) accuracy are low",
+    "lr_high": "LEARNING RATE TOO HIGH: Loss is oscillating significantly",
+    "lr_low": "LEARNING RATE TOO LOW: Model is converging very slowly",
+    "small_data": "SMALL DATASET WARNING: Only {dataset_size} samples may not be sufficient",
+    "small_batch": "BATCH SIZE TOO SMALL: Batch size of {batch_size} may cause noisy gradients",
+    "good": "GOOD MODEL: Train ({train_accuracy}%) and test ({test_accuracy}%) accuracy are both high and balanced",
+}
+
+# When each issue applies, in words, filled in from THRESHOLDS (keyed like DIAG_TEMPLATES)
+ISSUE_CONDITIONS = {
+    "overfitting": "train accuracy more than {overfit_gap} points above test accuracy",
+    "underfitting": "train accuracy below {underfit_train}% and within {underfit_gap} points of test accuracy",
+    "lr_high": "loss oscillating heavily",
+    "lr_low": "very slow convergence",
+    "small_data": "fewer than {small_dataset} samples",
+    "small_batch": "batch size below {small_batch} with more than {small_dataset} samples",
+    "good": "train accuracy at least {good_train}%, test at least {good_test}%, within {good_gap} points",
+}
+
+# Recommendations for each rule, shared by the rule table and the experta rules
+_REC_OVERFIT = (
+    "Add regularization (L1/L2)",
+    "Increase dropout rate (try 0.3-0.5)",
+    "Use data augmentation",
+    "Reduce model complexity",
+    "Get more training data",
+)
+_REC_UNDERFIT = (
+    "Increase model complexity",
+    "Add more features",
+    "Train for more epochs",
+    "Reduce regularization",
+    "Check if data preprocessing is correct",
+)
+_REC_LR_HIGH = (
+    "Reduce learning rate by factor of 10 (e.g., 0.01 -> 0.001)",
+    "Use learning rate scheduler",
+    "Try Adam optimizer with default LR (0.001)",
+)
+_REC_LR_LOW = (
+    "Increase learning rate gradually",
+    "Try learning rate finder",
+    "Use cyclic learning rate",
+)
+_REC_SMALL_DATA = (
+    "Use data augmentation heavily",
+    "Consider transfer learning",
+    "Use simpler model architecture",
+    "Collect more data if possible",
+)
+_REC_SMALL_BATCH = (
+    "Increase batch size to 32-128",
+    "Use gradient accumulation if memory limited",
+    "Adjust learning rate proportionally",
+)
+_REC_GOOD = (
+    "Model is performing well!",
+    "Consider fine-tuning hyperparameters for marginal improvements",
+    "Monitor for overfitting with more epochs",
+)
+
+
+def _experta_classes():
+    """
+    Define the experta fact and engine classes
     
-    def __init__(self):
-        super().__init__()
-        self.diagnoses = []
-        self.recommendations = []
+    experta is only needed for ML_DEBUG_ENGINE=experta, so it is imported and
+    the rules are defined the first time that engine is used.
     
-    # Rule 1: Overfitting Detection
-    @Rule(MLMetrics(train_accuracy=MATCH.ta, test_accuracy=MATCH.tea),
-          TEST(lambda ta, tea: ta - tea > 15))
-    def overfitting(self, ta, tea):
-        diagnosis = f"OVERFITTING DETECTED: Train accuracy ({ta}%) significantly higher than test accuracy ({tea}%)"
-        self.diagnoses.append(diagnosis)
-        self.recommendations.extend([
-            "Add regularization (L1/L2)",
-            "Increase dropout rate (try 0.3-0.5)",
-            "Use data augmentation",
-            "Reduce model complexity",
-            "Get more training data"
-        ])
-        self.declare(Fact(issue="overfitting"))
+    Returns:
+        tuple: (MLMetrics fact class, MLDebugExpert engine class)
+    """
+    # Ensure backwards compatibility for older packages that reference
+    # `collections.Mapping` on newer Python versions (Mapping moved to
+    # `collections.abc`). The `compat` module provides aliases when
+    # necessary and must be imported before importing `experta`.
+    import compat  # noqa: F401 (module side-effects)
+    from experta import Fact, KnowledgeEngine, MATCH, P, Rule
     
-    # Rule 2: Underfitting Detection
-    @Rule(MLMetrics(train_accuracy=MATCH.ta, test_accuracy=MATCH.tea),
-          TEST(lambda ta, tea: ta < 70 and abs(ta - tea) < 10))
-    def underfitting(self, ta, tea):
-        diagnosis = f"UNDERFITTING DETECTED: Both train ({ta}%) and test ({tea}%) accuracy are low"
-        self.diagnoses.append(diagnosis)
-        self.recommendations.extend([
-            "Increase model complexity",
-            "Add more features",
-            "Train for more epochs",
-            "Reduce regularization",
-            "Check if data preprocessing is correct"
-        ])
-        self.declare(Fact(issue="underfitting"))
+    class MLMetrics(Fact):
+        """Fact to store ML training metrics"""
+        pass
+
+    class MLDebugExpert(KnowledgeEngine):
+        """Expert system for diagnosing ML training issues"""
+        
+        def __init__(self):
+            super().__init__()
+            self.diagnoses = []
+            self.recommendations = {}  # ordered set: recommendation -> None
+        
+        # Rule 1: Overfitting Detection
+        @Rule(MLMetrics(train_accuracy=MATCH.ta, test_accuracy=MATCH.tea,
+                        acc_gap=P(_gap_overfit)))
+        def overfitting(self, ta, tea):
+            diagnosis = DIAG_TEMPLATES["overfitting"].format(train_accuracy=ta, test_accuracy=tea)
+            self.diagnoses.append(diagnosis)
+            self.recommendations.update(dict.fromkeys(_REC_OVERFIT))
+            self.declare(Fact(issue="overfitting"))
+        
+        # Rule 2: Underfitting Detection
+        @Rule(MLMetrics(train_accuracy=MATCH.ta & P(_train_underfit), test_accuracy=MATCH.tea,
+                        acc_gap=P(_gap_underfit)))
+        def underfitting(self, ta, tea):
+            diagnosis = DIAG_TEMPLATES["underfitting"].format(train_accuracy=ta, test_accuracy=tea)
+            self.diagnoses.append(diagnosis)
+            self.recommendations.update(dict.fromkeys(_REC_UNDERFIT))
+            self.declare(Fact(issue="underfitting"))
+        
+        # Rule 3: Learning Rate Too High
+        @Rule(MLMetrics(loss_oscillation="high"))
+        def lr_too_high(self):
+            diagnosis = DIAG_TEMPLATES["lr_high"]
+            self.diagnoses.append(diagnosis)
+            self.recommendations.update(dict.fromkeys(_REC_LR_HIGH))
+            self.declare(Fact(issue="lr_high"))
+        
+        # Rule 4: Learning Rate Too Low
+        @Rule(MLMetrics(convergence_speed="very_slow"))
+        def lr_too_low(self):
+            diagnosis = DIAG_TEMPLATES["lr_low"]
+            self.diagnoses.append(diagnosis)
+            self.recommendations.update(dict.fromkeys(_REC_LR_LOW))
+            self.declare(Fact(issue="lr_low"))
+        
+        # Rule 5: Small Dataset Issue
+        @Rule(MLMetrics(dataset_size=MATCH.size & P(_dataset_small)))
+        def small_dataset(self, size):
+            diagnosis = DIAG_TEMPLATES["small_data"].format(dataset_size=size)
+            self.diagnoses.append(diagnosis)
+            self.recommendations.update(dict.fromkeys(_REC_SMALL_DATA))
+            self.declare(Fact(issue="small_data"))
+        
+        # Rule 6: Batch Size Issue (Too Small)
+        @Rule(MLMetrics(batch_size=MATCH.bs & P(_batch_small), dataset_size=P(_dataset_large)))
+        def batch_too_small(self, bs):
+            diagnosis = DIAG_TEMPLATES["small_batch"].format(batch_size=bs)
+            self.diagnoses.append(diagnosis)
+            self.recommendations.update(dict.fromkeys(_REC_SMALL_BATCH))
+            self.declare(Fact(issue="small_batch"))
+        
+        # Rule 7: Good Performance
+        @Rule(MLMetrics(train_accuracy=MATCH.ta & P(_train_good), test_accuracy=MATCH.tea & P(_test_good),
+                        acc_gap=P(_gap_good)))
+        def good_performance(self, ta, tea):
+            diagnosis = DIAG_TEMPLATES["good"].format(train_accuracy=ta, test_accuracy=tea)
+            self.diagnoses.append(diagnosis)
+            self.recommendations.update(dict.fromkeys(_REC_GOOD))
+            self.declare(Fact(issue="good"))
+        
+        def get_results(self):
+            """Return diagnosis and recommendations"""
+            return {
+                "diagnoses": self.diagnoses,
+                "recommendations": list(self.recommendations),  # Already de-duplicated, in firing order
+                "issues_found": len(self.diagnoses)
+            }
+        
+        def reset_results(self):
+            """Reset diagnosis and recommendations"""
+            self.diagnoses = []
+            self.recommendations = {}
     
+    return MLMetrics, MLDebugExpert
+
+
+# Decision table mirroring the MLDebugExpert rules:
+# (required metric fields, predicate, diagnosis template, recommendations).
+# The rules are independent threshold checks, so evaluating them directly gives the same
+# result as the engine without building a RETE network for every call. A rule is only
+# tested when its required fields are present, so predicates can index metrics directly.
+_ACCURACIES = frozenset({"train_accuracy", "test_accuracy"})
+RULES = [
+    # Rule 1: Overfitting Detection
+    (_ACCURACIES,
+     lambda m: _gap_overfit(m["acc_gap"]),
+     DIAG_TEMPLATES["overfitting"], _REC_OVERFIT),
+    # Rule 2: Underfitting Detection
+    (_ACCURACIES,
+     lambda m: _train_underfit(m["train_accuracy"]) and _gap_underfit(m["acc_gap"]),
+     DIAG_TEMPLATES["underfitting"], _REC_UNDERFIT),
     # Rule 3: Learning Rate Too High
-    @Rule(MLMetrics(loss_oscillation=MATCH.osc),
-          TEST(lambda osc: osc == "high"))
-    def lr_too_high(self):
-        diagnosis = "LEARNING RATE TOO HIGH: Loss is oscillating significantly"
-        self.diagnoses.append(diagnosis)
-        self.recommendations.extend([
-            "Reduce learning rate by factor of 10 (e.g., 0.01 -> 0.001)",
-            "Use learning rate scheduler",
-            "Try Adam optimizer with default LR (0.001)"
-        ])
-        self.declare(Fact(issue="lr_high"))
-    
+    (frozenset({"loss_oscillation"}),
+     lambda m: m["loss_oscillation"] == "high",
+     DIAG_TEMPLATES["lr_high"], _REC_LR_HIGH),
     # Rule 4: Learning Rate Too Low
-    @Rule(MLMetrics(convergence_speed=MATCH.speed),
-          TEST(lambda speed: speed == "very_slow"))
-    def lr_too_low(self):
-        diagnosis = "LEARNING RATE TOO LOW: Model is converging very slowly"
-        self.diagnoses.append(diagnosis)
-        self.recommendations.extend([
-            "Increase learning rate gradually",
-            "Try learning rate finder",
-            "Use cyclic learning rate"
-        ])
-        self.declare(Fact(issue="lr_low"))
-    
+    (frozenset({"convergence_speed"}),
+     lambda m: m["convergence_speed"] == "very_slow",
+     DIAG_TEMPLATES["lr_low"], _REC_LR_LOW),
     # Rule 5: Small Dataset Issue
-    @Rule(MLMetrics(dataset_size=MATCH.size),
-          TEST(lambda size: size < 1000))
-    def small_dataset(self, size):
-        diagnosis = f"SMALL DATASET WARNING: Only {size} samples may not be sufficient"
-        self.diagnoses.append(diagnosis)
-        self.recommendations.extend([
-            "Use data augmentation heavily",
-            "Consider transfer learning",
-            "Use simpler model architecture",
-            "Collect more data if possible"
-        ])
-        self.declare(Fact(issue="small_data"))
-    
+    (frozenset({"dataset_size"}),
+     lambda m: _dataset_small(m["dataset_size"]),
+     DIAG_TEMPLATES["small_data"], _REC_SMALL_DATA),
     # Rule 6: Batch Size Issue (Too Small)
-    @Rule(MLMetrics(batch_size=MATCH.bs, dataset_size=MATCH.ds),
-          TEST(lambda bs, ds: bs < 16 and ds > 1000))
-    def batch_too_small(self, bs):
-        diagnosis = f"BATCH SIZE TOO SMALL: Batch size of {bs} may cause noisy gradients"
-        self.diagnoses.append(diagnosis)
-        self.recommendations.extend([
-            "Increase batch size to 32-128",
-            "Use gradient accumulation if memory limited",
-            "Adjust learning rate proportionally"
-        ])
-        self.declare(Fact(issue="small_batch"))
-    
+    (frozenset({"batch_size", "dataset_size"}),
+     lambda m: _batch_small(m["batch_size"]) and _dataset_large(m["dataset_size"]),
+     DIAG_TEMPLATES["small_batch"], _REC_SMALL_BATCH),
     # Rule 7: Good Performance
-    @Rule(MLMetrics(train_accuracy=MATCH.ta, test_accuracy=MATCH.tea),
-          TEST(lambda ta, tea: ta >= 85 and tea >= 80 and abs(ta - tea) <= 10))
-    def good_performance(self, ta, tea):
-        diagnosis = f"GOOD MODEL: Train ({ta}%) and test ({tea}%) accuracy are both high and balanced"
-        self.diagnoses.append(diagnosis)
-        self.recommendations.extend([
-            "Model is performing well!",
-            "Consider fine-tuning hyperparameters for marginal improvements",
-            "Monitor for overfitting with more epochs"
-        ])
-        self.declare(Fact(issue="good"))
-    
-    def get_results(self):
-        """Return diagnosis and recommendations"""
-        return {
-            "diagnoses": self.diagnoses,
-            "recommendations": list(set(self.recommendations)),  # Remove duplicates
-            "issues_found": len(self.diagnoses)
-        }
-    
-    def reset_results(self):
-        """Reset diagnosis and recommendations"""
-        self.diagnoses = []
-        self.recommendations = []
+    (_ACCURACIES,
+     lambda m: (_train_good(m["train_accuracy"]) and _test_good(m["test_accuracy"])
+                and _gap_good(m["acc_gap"])),
+     DIAG_TEMPLATES["good"], _REC_GOOD),
+]
+
+# Set ML_DEBUG_ENGINE=experta to run the original experta KnowledgeEngine instead
+USE_EXPERTA = os.getenv("ML_DEBUG_ENGINE", "").lower() == "experta"
+
+
+def _prepare(metrics):
+    """Copy metrics and precompute the accuracy gap once instead of in every rule test"""
+    metrics = dict(metrics)
+    if "train_accuracy" in metrics and "test_accuracy" in metrics:
+        metrics["acc_gap"] = metrics["train_accuracy"] - metrics["test_accuracy"]
+    return metrics
+
+
+def _can_fire(metrics):
+    """Check whether metrics has the fields required by at least one rule"""
+    return any(fields <= metrics.keys() for fields, _, _, _ in RULES)
+
+
+def _empty_result():
+    """Result for metrics that no rule could match"""
+    return {"diagnoses": [], "recommendations": [], "issues_found": 0}
 
 
 def run_diagnosis(metrics):
@@ -143,17 +290,81 @@ def run_diagnosis(metrics):
     Returns:
         dict: Diagnosis results and recommendations
     """
-    engine = MLDebugExpert()
-    engine.reset()
-    engine.reset_results()
+    return run_diagnosis_batch([metrics])[0]
+
+
+def run_diagnosis_batch(records):
+    """
+    Run expert system diagnosis on many sets of metrics at once
+    
+    Each rule is evaluated over all records in turn, so its template and
+    recommendations are prepared once per batch rather than once per record.
+    
+    Args:
+        records (list): Dictionaries containing ML training metrics
+        
+    Returns:
+        list: Diagnosis results for each record, in the same order
+    """
+    records = [_prepare(metrics) for metrics in records]
+    
+    if USE_EXPERTA:
+        # Skip the engine entirely when no rule could match the given fields
+        return [run_experta_diagnosis(metrics) if _can_fire(metrics) else _empty_result()
+                for metrics in records]
     
-    # Declare facts
-    engine.declare(MLMetrics(**metrics))
+    diagnoses = [[] for _ in records]
+    recommendations = [{} for _ in records]
+    for fields, predicate, template, recs in RULES:
+        rule_recs = dict.fromkeys(recs)
+        for i, metrics in enumerate(records):
+            if fields <= metrics.keys() and predicate(metrics):
+                diagnoses[i].append(template.format_map(metrics))
+                recommendations[i].update(rule_recs)
     
-    # Run inference
-    engine.run()
+    return [
+        {
+            "diagnoses": found,
+            "recommendations": list(recs),
+            "issues_found": len(found)
+        }
+        for found, recs in zip(diagnoses, recommendations)
+    ]
+
+
+# One engine is built on first use and reset for every run (its rule network is
+# compiled only once); the lock keeps concurrent callers from sharing a run
+_ENGINE = None
+_METRICS_FACT = None
+_ENGINE_LOCK = threading.Lock()
+
+
+def run_experta_diagnosis(metrics):
+    """
+    Run the experta KnowledgeEngine on metrics (acc_gap already computed)
     
-    return engine.get_results()
+    Args:
+        metrics (dict): Dictionary containing ML training metrics
+        
+    Returns:
+        dict: Diagnosis results and recommendations
+    """
+    global _ENGINE, _METRICS_FACT
+    
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            _METRICS_FACT, engine_class = _experta_classes()
+            _ENGINE = engine_class()
+        _ENGINE.reset()
+        _ENGINE.reset_results()
+        
+        # Declare facts
+        _ENGINE.declare(_METRICS_FACT(**metrics))
+        
+        # Run inference
+        _ENGINE.run()
+        
+        return _ENGINE.get_results()
 
 
 # Example usage
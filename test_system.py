@@ -9,27 +9,64 @@ import os
 # Add current directory to path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+# Expert system scenarios: (metrics, expected issue labels from DIAG_TEMPLATES)
+CASES = [
+    ({"train_accuracy": 95, "test_accuracy": 68}, {"overfitting"}),
+    ({"train_accuracy": 65, "test_accuracy": 63}, {"underfitting"}),
+    ({"train_accuracy": 92, "test_accuracy": 88}, {"good"}),
+    ({"loss_oscillation": "high"}, {"lr_high"}),
+    ({"loss_oscillation": "low"}, set()),
+    ({"convergence_speed": "very_slow"}, {"lr_low"}),
+    ({"convergence_speed": "slow"}, set()),
+    ({"dataset_size": 500}, {"small_data"}),
+    ({"dataset_size": 1000}, set()),
+    ({"batch_size": 8, "dataset_size": 5000}, {"small_batch"}),
+    ({"batch_size": 8, "dataset_size": 800}, {"small_data"}),
+    ({"batch_size": 16, "dataset_size": 5000}, set()),
+    ({"batch_size": 8}, set()),
+    ({"train_accuracy": 95, "test_accuracy": 68, "dataset_size": 500}, {"overfitting", "small_data"}),
+    ({"train_accuracy": 65, "test_accuracy": 63, "convergence_speed": "very_slow"}, {"underfitting", "lr_low"}),
+    ({"train_accuracy": 92, "test_accuracy": 88, "batch_size": 8, "dataset_size": 5000}, {"good", "small_batch"}),
+    ({"train_accuracy": 80, "test_accuracy": 75}, set()),
+    ({"train_accuracy": 85, "test_accuracy": 80}, {"good"}),
+    ({"train_accuracy": 96, "test_accuracy": 81}, set()),
+    ({"train_accuracy": 96, "test_accuracy": 80.9}, {"overfitting"}),
+    ({"train_accuracy": 60, "test_accuracy": 75}, set()),
+    ({"train_accuracy": 69, "test_accuracy": 60}, {"underfitting"}),
+    ({"loss_oscillation": "high", "convergence_speed": "very_slow", "dataset_size": 200},
+     {"lr_high", "lr_low", "small_data"}),
+    ({"train_accuracy": 95, "test_accuracy": 68, "loss_oscillation": "high", "dataset_size": 500, "batch_size": 8},
+     {"overfitting", "lr_high", "small_data"}),
+    ({}, set()),
+]
+
 def test_expert_system():
     """Test the expert system without API"""
     print("=" * 60)
     print("TEST 1: Expert System (No API Required)")
     print("=" * 60)
     try:
-        from ml_debugging_expert import run_diagnosis
+        from ml_debugging_expert import DIAG_TEMPLATES, run_diagnosis_batch
+        
+        # Map each diagnosis heading (e.g. "OVERFITTING DETECTED") back to its issue label
+        labels = {template.split(":")[0]: issue for issue, template in DIAG_TEMPLATES.items()}
         
-        metrics = {
-            "train_accuracy": 95,
-            "test_accuracy": 68
-        }
+        results = run_diagnosis_batch([metrics for metrics, _ in CASES])
         
-        result = run_diagnosis(metrics)
+        failures = []
+        for (metrics, expected), result in zip(CASES, results):
+            found = {labels[diagnosis.split(":")[0]] for diagnosis in result["diagnoses"]}
+            recs = result["recommendations"]
+            if found != expected or len(set(recs)) != len(recs):
+                failures.append((metrics, expected, found))
         
-        if "diagnoses" in result and len(result["diagnoses"]) > 0:
-            print("✅ Expert system works!")
-            print(f"   Diagnosis: {result['diagnoses'][0][:60]}...")
+        if not failures:
+            print(f"✅ Expert system works! ({len(CASES)} scenarios)")
             return True
         else:
-            print("❌ Expert system failed - no diagnoses returned")
+            print(f"❌ Expert system failed {len(failures)}/{len(CASES)} scenarios:")
+            for metrics, expected, found in failures:
+                print(f"   {metrics}: expected {sorted(expected)}, got {sorted(found)}")
             return False
             
     except Exception as e:
@@ -94,6 +131,147 @@ def test_imports():
     
     return all_ok
 
+# Local extraction scenarios: (query, expected metrics; {} means "ask Gemini")
+LOCAL_CASES = [
+    ("train 92% test 68%", {"train_accuracy": 92, "test_accuracy": 68}),
+    ("test accuracy 68% train accuracy 92%", {"train_accuracy": 92, "test_accuracy": 68}),
+    ("validation 70% train 95% test 60%", {"validation_accuracy": 70, "train_accuracy": 95, "test_accuracy": 60}),
+    ("92% train / 68% test", {"train_accuracy": 92, "test_accuracy": 68}),
+    ("95% train 70% test", {"train_accuracy": 95, "test_accuracy": 70}),
+    ("My model gets 92% accuracy on training but only 68% on test set", {"train_accuracy": 92, "test_accuracy": 68}),
+    ("train accuracy is 92% and 68% on test", {"train_accuracy": 92, "test_accuracy": 68}),
+    ("training accuracy of 0.92, test accuracy of 0.68, batch size 8",
+     {"train_accuracy": 92, "test_accuracy": 68, "batch_size": 8}),
+    ("training set of 5,000 samples, 92% train 68% test",
+     {"train_accuracy": 92, "test_accuracy": 68, "dataset_size": 5000}),
+    ("a dataset of 800 images, train 92% test 68%",
+     {"train_accuracy": 92, "test_accuracy": 68, "dataset_size": 800}),
+    ("train 95% test 1%", {"train_accuracy": 95, "test_accuracy": 1}),
+    ("32 samples per batch, train 92% test 68%", {}),
+    ("train 92% test 68% train 90%", {}),
+    ("train 92% 70% test 60%", {}),
+    ("loss oscillates, train 92 test 68", {}),
+]
+
+def test_local_extraction():
+    """Test the local (regex) metric extraction without API"""
+    print("\n" + "=" * 60)
+    print("TEST 4: Local Metric Extraction (No API Required)")
+    print("=" * 60)
+    try:
+        from gemini_integration import _extract_local
+        
+        failures = []
+        for query, expected in LOCAL_CASES:
+            found = _extract_local(query)
+            if found != expected:
+                failures.append((query, expected, found))
+        
+        if not failures:
+            print(f"✅ Local extraction works! ({len(LOCAL_CASES)} queries)")
+            return True
+        else:
+            print(f"❌ Local extraction failed {len(failures)}/{len(LOCAL_CASES)} queries:")
+            for query, expected, found in failures:
+                print(f"   {query!r}: expected {expected}, got {found}")
+            return False
+            
+    except Exception as e:
+        print(f"❌ Local extraction failed: {e}")
+        return False
+
+def test_response_cache():
+    """Test the response cache modes and expiry with a fake model (no API)"""
+    print("\n" + "=" * 60)
+    print("TEST 5: Response Cache (No API Required)")
+    print("=" * 60)
+    try:
+        import tempfile
+        import time
+        from gemini_integration import _CachedModel
+        
+        class FakeResponse:
+            def __init__(self, text):
+                self.text = text
+        
+        class FakeModel:
+            """Counts calls and answers with a response no other call returns"""
+            responses = 0
+            
+            def __init__(self):
+                self.calls = 0
+            
+            def generate_content(self, prompt, **kwargs):
+                self.calls += 1
+                FakeModel.responses += 1
+                return FakeResponse(f"response {FakeModel.responses}")
+        
+        def cached(mode, ttl=None):
+            model = FakeModel()
+            return model, _CachedModel(model, "fake-model", path=path, mode=mode, ttl=ttl)
+        
+        checks = []
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.sqlite")
+            
+            # enabled: the second identical prompt is served from the cache
+            model, cache = cached("enabled")
+            first = cache.generate_content("prompt").text
+            second = cache.generate_content("prompt").text
+            checks.append(("enabled serves hits", first == second and model.calls == 1))
+            
+            # replay: cached prompts are served, anything else is refused
+            model, cache = cached("replay")
+            checks.append(("replay serves hits", cache.generate_content("prompt").text == first))
+            try:
+                cache.generate_content("new prompt")
+                checks.append(("replay refuses misses", False))
+            except LookupError:
+                checks.append(("replay refuses misses", model.calls == 0))
+            
+            # write-only: always calls the API and refreshes the cache
+            model, cache = cached("write-only")
+            refreshed = cache.generate_content("prompt").text
+            checks.append(("write-only calls the API", model.calls == 1 and refreshed != first))
+            _, cache = cached("enabled")
+            checks.append(("write-only refreshes", cache.generate_content("prompt").text == refreshed))
+            
+            # disabled: always calls the API
+            model, cache = cached("disabled")
+            cache.generate_content("prompt")
+            cache.generate_content("prompt")
+            checks.append(("disabled always calls", model.calls == 2))
+            
+            # TTL: expired entries are missed and pruned
+            model, cache = cached("enabled", ttl=0.05)
+            cache.generate_content("short-lived")
+            time.sleep(0.1)
+            cache.generate_content("short-lived")
+            checks.append(("expired entries miss", model.calls == 2))
+            time.sleep(0.1)
+            checks.append(("prune removes expired", cache.prune() >= 1))
+            
+            # replay without a usable cache file (here a directory) is refused too
+            path = tmp
+            _, cache = cached("replay")
+            try:
+                cache.generate_content("prompt")
+                checks.append(("replay needs a cache", False))
+            except LookupError:
+                checks.append(("replay needs a cache", True))
+        
+        failures = [name for name, ok in checks if not ok]
+        if not failures:
+            print(f"✅ Response cache works! ({len(checks)} checks)")
+            return True
+        else:
+            print(f"❌ Response cache failed: {', '.join(failures)}")
+            return False
+            
+    except Exception as e:
+        print(f"❌ Response cache failed: {e}")
+        return False
+
 def main():
     """Run all tests"""
     print("\n" + "🧪 ML Debugging Expert System - Test Suite")
@@ -105,6 +283,8 @@ def main():
     results.append(("Imports", test_imports()))
     results.append(("Expert System", test_expert_system()))
     results.append(("Gemini API", test_gemini_integration()))
+    results.append(("Local Extraction", test_local_extraction()))
+    results.append(("Response Cache", test_response_cache()))
     
     # Summary
     print("\n" + "=" * 60)